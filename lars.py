@@ -112,37 +112,55 @@ class LARS(Optimizer):
             dampening = group["dampening"]
             nesterov = group["nesterov"]
 
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-
-                d_p = p.grad
-                p_norm = torch.norm(p.data)
-                g_norm = torch.norm(p.grad.data)
-
-                # lars scaling + weight decay part
-                if weight_decay != 0:
-                    if p_norm != 0 and g_norm != 0:
-                        lars_lr = p_norm / (g_norm + p_norm * weight_decay + group["eps"])
-                        lars_lr *= group["trust_coefficient"]
-
-                        d_p = d_p.add(p, alpha=weight_decay)
-                        d_p *= lars_lr
-
-                # sgd part
-                if momentum != 0:
+            # Use multi-tensor (foreach) kernels on all parameters of the group at once
+            params = [p for p in group["params"] if p.grad is not None]
+            if len(params) == 0:
+                continue
+            grads = [p.grad for p in params]
+
+            # lars scaling + weight decay part
+            if weight_decay != 0:
+                p_norms = torch.stack(torch._foreach_norm(params))
+                g_norms = torch.stack(torch._foreach_norm(grads))
+
+                # Parameters or gradients with 0 norm are not scaled, and do not
+                # get weight decay (computed without host synchronization)
+                scaled = (p_norms != 0) & (g_norms != 0)
+                lars_lr = p_norms / (g_norms + p_norms * weight_decay + group["eps"])
+                lars_lr *= group["trust_coefficient"]
+                lars_lr = torch.where(scaled, lars_lr, torch.ones_like(lars_lr))
+                decay = torch.where(scaled, lars_lr * weight_decay, torch.zeros_like(lars_lr))
+
+                d_ps = torch._foreach_mul(grads, list(lars_lr.unbind()))
+                torch._foreach_add_(d_ps, torch._foreach_mul(params, list(decay.unbind())))
+            else:
+                d_ps = grads
+
+            # sgd part
+            if momentum != 0:
+                bufs = []
+                existing_bufs = []
+                existing_d_ps = []
+                for p, d_p in zip(params, d_ps):
                     param_state = self.state[p]
                     if "momentum_buffer" not in param_state:
                         buf = param_state["momentum_buffer"] = torch.clone(d_p).detach()
                     else:
                         buf = param_state["momentum_buffer"]
-                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
-                    if nesterov:
-                        d_p = d_p.add(buf, alpha=momentum)
-                    else:
-                        d_p = buf
+                        existing_bufs.append(buf)
+                        existing_d_ps.append(d_p)
+                    bufs.append(buf)
+
+                if len(existing_bufs) > 0:
+                    torch._foreach_mul_(existing_bufs, momentum)
+                    torch._foreach_add_(existing_bufs, existing_d_ps, alpha=1 - dampening)
+
+                if nesterov:
+                    d_ps = torch._foreach_add(d_ps, bufs, alpha=momentum)
+                else:
+                    d_ps = bufs
 
-                p.add_(d_p, alpha=-group["lr"])
+            torch._foreach_add_(params, d_ps, alpha=-group["lr"])
 
         return loss
     
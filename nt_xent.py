@@ -21,31 +21,30 @@ class Gather(torch.autograd.Function):
     @staticmethod
     def forward(ctx, tensor):
         
-        # Save batch size to the context, for later use in backward
-        ctx.batch_size = tensor.shape[0]
-        
-        gathered = [torch.zeros_like(tensor) for _ in range(dist.get_world_size())]
-        dist.all_gather(gathered, tensor)
+        # Gather directly into a single tensor, instead of a list of tensors
+        # to concatenate
+        gathered = torch.empty((dist.get_world_size()*tensor.shape[0], *tensor.shape[1:]),
+                               dtype=tensor.dtype, device=tensor.device)
+        dist.all_gather_into_tensor(gathered, tensor.contiguous())
         
         # The output is the complete batch
-        return torch.cat(gathered, dim=0)
+        return gathered
 
     @staticmethod
     def backward(ctx, grad_output):
         
-        # clone() is differentiable
-        grad_input = grad_output.clone()
-        
         # reduce is needed since the loss will be computed only for the 
         # batch of each process, and not directly using the whole gathered output
-        # (this is coherent with PyTorch structure)
-        dist.all_reduce(grad_input, op=dist.ReduceOp.SUM, async_op=False)
-
-        # Get the indices of the batch of the current process
-        start = dist.get_rank()*ctx.batch_size
-        end = (dist.get_rank() + 1)*ctx.batch_size
+        # (this is coherent with PyTorch structure). A reduce-scatter directly
+        # gives the part corresponding to the batch of the current process, with
+        # half the communication volume of an all-reduce followed by slicing
+        grad_input = torch.empty((grad_output.shape[0] // dist.get_world_size(),
+                                  *grad_output.shape[1:]),
+                                 dtype=grad_output.dtype, device=grad_output.device)
+        dist.reduce_scatter_tensor(grad_input, grad_output.contiguous(),
+                                   op=dist.ReduceOp.SUM)
         
-        return grad_input[start:end]
+        return grad_input
     
     
     
@@ -72,6 +71,87 @@ def gather(tensor):
     
     
     
+class TiledLogSumExp(torch.autograd.Function):
+    """
+    Compute the log-sum-exp of the similarity between every row of `z` and every
+    row of `z_tot` (excluding the similarity of each example with itself), without
+    ever materializing the full similarity matrix. The columns are processed by
+    tiles, and the row maxima and sums of exponentials are accumulated online.
+    Only the log-sum-exp of each row is saved for backward, where the tiles are
+    recomputed. Peak memory is thus O(N*T) instead of O(N^2).
+    """
+    
+    @staticmethod
+    def forward(ctx, z, z_tot, self_index, columns, temperature, tile_size):
+        
+        N = z.shape[0]
+        running_max = torch.full((N,), -float('inf'), dtype=z.dtype, device=z.device)
+        running_sum = torch.zeros(N, dtype=z.dtype, device=z.device)
+        
+        for start in range(0, z_tot.shape[0], tile_size):
+            similarity = _similarity_tile(z, z_tot, self_index, columns,
+                                          temperature, start, tile_size)
+            
+            # Online update of the maxima and (rescaled) sums of exponentials.
+            # The maximum is still -inf if all columns seen so far are masked
+            # (e.g. tiles of size 1), in which case we shift by 0 to avoid NaNs
+            new_max = torch.max(running_max, similarity.max(dim=1).values)
+            shift = torch.where(new_max == -float('inf'), torch.zeros_like(new_max),
+                                new_max)
+            running_sum = running_sum*torch.exp(running_max - shift) + \
+                torch.exp(similarity - shift.unsqueeze(1)).sum(dim=1)
+            running_max = new_max
+            
+        lse = running_max + torch.log(running_sum)
+        
+        ctx.save_for_backward(z, z_tot, self_index, columns, lse)
+        ctx.temperature = temperature
+        ctx.tile_size = tile_size
+        
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        
+        z, z_tot, self_index, columns, lse = ctx.saved_tensors
+        temperature = ctx.temperature
+        tile_size = ctx.tile_size
+        
+        grad_z = torch.zeros_like(z)
+        grad_z_tot = torch.zeros_like(z_tot)
+        
+        for start in range(0, z_tot.shape[0], tile_size):
+            similarity = _similarity_tile(z, z_tot, self_index, columns,
+                                          temperature, start, tile_size)
+            
+            # Gradient of the log-sum-exp with respect to the similarities is
+            # the softmax of the row (the masked diagonal gives exactly 0)
+            weights = torch.exp(similarity - lse.unsqueeze(1)) * grad_output.unsqueeze(1)
+            weights /= temperature
+            
+            end = start + similarity.shape[1]
+            grad_z += torch.mm(weights, z_tot[start:end])
+            grad_z_tot[start:end] = torch.mm(weights.t(), z)
+            
+        return grad_z, grad_z_tot, None, None, None, None
+    
+    
+    
+def _similarity_tile(z, z_tot, self_index, columns, temperature, start, tile_size):
+    """
+    Compute one tile (a subset of the columns) of the similarity matrix, where
+    the similarity of each example with itself is set to -inf.
+    """
+    
+    end = min(start + tile_size, z_tot.shape[0])
+    similarity = torch.mm(z, z_tot[start:end].t()) / temperature
+    
+    mask = self_index.unsqueeze(1) == columns[start:end].unsqueeze(0)
+    
+    return similarity.masked_fill(mask, -float('inf'))
+    
+    
+    
 class NT_Xent(torch.nn.Module):
     """
     Class implementing the NT-Xent loss function.
@@ -82,16 +162,61 @@ class NT_Xent(torch.nn.Module):
         The temperature.
     epsilon : float, optional
         A small number for numerical stability. The default is 1e-7.
+    tile_size : int, optional
+        The number of columns of the similarity matrix computed at once. The
+        full matrix is never materialized. The default is 512.
 
     """
     
-    def __init__(self, temperature, epsilon=1e-7):
+    def __init__(self, temperature, epsilon=1e-7, tile_size=512):
         
         super(NT_Xent, self).__init__()
         self.temperature = temperature
         self.epsilon = epsilon
+        self.tile_size = tile_size
+        
+        # Indices used to mask the similarity of each example with itself. They
+        # are computed lazily on the first call, as they depend on the batch size
+        self.register_buffer('self_index', None, persistent=False)
+        self.register_buffer('columns', None, persistent=False)
+        
+        
+    def get_indices(self, batch_size, total_size, offset, device):
+        """
+        Return the (cached) index of each example of the current process inside
+        the gathered batch, and the index of every column of the similarity matrix.
+        They are only recomputed if the batch size changes.
+
+        Parameters
+        ----------
+        batch_size : int
+            The batch size of the current process.
+        total_size : int
+            The batch size across all processes.
+        offset : int
+            The index of the first example of the current process in the gathered batch.
+        device : torch.device
+            The device on which to create the indices.
+
+        Returns
+        -------
+        self_index : Tensor
+            Column index of the similarity s_i_i for each row i.
+        columns : Tensor
+            Index of every column.
+
+        """
+        
+        if self.self_index is None or self.self_index.shape[0] != 2*batch_size \
+            or self.columns.shape[0] != 2*total_size or self.columns.device != device:
+            index = torch.arange(offset, offset + batch_size, device=device)
+            self.self_index = torch.cat((index, index + total_size), dim=0)
+            self.columns = torch.arange(2*total_size, device=device)
+            
+        return self.self_index, self.columns
+    
 
-    def forward(self, z1, z2):
+    def forward(self, z1, z2, reduction='mean'):
         """
         Compute the NT-Xent loss. Note that in a distributed training framework,
         this only computes the loss with respect to the batch seen by each process.
@@ -104,54 +229,70 @@ class NT_Xent(torch.nn.Module):
             Model output corresponding to the first data augmentation.
         z2 : Tensor
             Model output corresponding to the second data augmentation.
+        reduction : str, optional
+            Either `mean` to average the loss over the batch, or `none` to return
+            the loss of each example (averaged over its 2 data augmentations).
+            The default is 'mean'.
 
         Returns
         -------
         loss : float (as a Tensor)
-            The loss value.
+            The loss value (or Tensor of the loss of each example if reduction
+            is `none`).
 
         """
         
+        # Always compute the loss in full precision (even under autocast) for
+        # numerical stability of the exponentials
+        with torch.autocast(device_type=z1.device.type, enabled=False):
+            return self._loss(z1.float(), z2.float(), reduction)
+        
+        
+    def _loss(self, z1, z2, reduction='mean'):
+        """
+        Compute the NT-Xent loss in the precision of the inputs. See `forward`.
+        """
+        
         # Normalize the vectors. Use max(norm, epsilon) for numerical stability
-        norm1 = torch.linalg.norm(z1, ord=2, dim=1)
-        norm2 = torch.linalg.norm(z2, ord=2, dim=1)
-
-        epsilon = self.epsilon*torch.ones(z1.shape[0],
-                                          1,
-                                          dtype=z1.dtype,
-                                          device=z1.device)
-        z1 = z1 / torch.max(norm1.unsqueeze(1), epsilon)
-        z2 = z2 / torch.max(norm2.unsqueeze(1), epsilon)
+        norm1 = torch.linalg.norm(z1, ord=2, dim=1, keepdim=True)
+        norm2 = torch.linalg.norm(z2, ord=2, dim=1, keepdim=True)
+        z1 = z1 / norm1.clamp(min=self.epsilon)
+        z2 = z2 / norm2.clamp(min=self.epsilon)
         
         # Gather batch from all processes
         if dist.is_available() and dist.is_initialized():
             z1_tot = gather(z1)
             z2_tot = gather(z2)
+            offset = dist.get_rank()*z1.shape[0]
         else:
             z1_tot = z1
             z2_tot = z2
+            offset = 0
         
         # Concatenate to make use of matrix multiplication
         z_tot = torch.cat((z1_tot, z2_tot), dim=0)
         z = torch.cat((z1, z2), dim=0)
         
-        # Compute pairwise cosine similarity
-        similarity = torch.mm(z, z_tot.t()) 
-        sim_exp = torch.exp(similarity / self.temperature)
+        # Index of each example of the current process inside z_tot, to remove
+        # the similarity s_i_i from the denominator
+        self_index, columns = self.get_indices(z1.shape[0], z1_tot.shape[0], offset,
+                                               z.device)
         
-        # Compute the denominator of the loss. See paper of SimCLRv1.
-        # We need to remove the unit similarity term corresponding to s_i_i
-        denominator = torch.sum(sim_exp, dim=1) - \
-            torch.exp(torch.tensor(1./self.temperature, dtype=z.dtype, device=z.device))
+        # Compute the log of the denominator of the loss. See paper of SimCLRv1.
+        log_denominator = TiledLogSumExp.apply(z, z_tot, self_index, columns,
+                                               self.temperature, self.tile_size)
         
         # Compute cosine similarity for the positives examples 
-        positives = torch.sum(z1 * z2, dim=1)
-        positives = torch.exp(positives / self.temperature)
+        positives = torch.sum(z1 * z2, dim=1) / self.temperature
         # Cosine similarity is symetric, thus s_i_j = s_j_i
         positives = torch.cat((positives, positives), dim=0)
         
-        loss = torch.mean(-torch.log(positives / denominator))
+        loss = log_denominator - positives
+        
+        if reduction == 'none':
+            # Average the loss of the 2 data augmentations of each example
+            return torch.stack(loss.chunk(2, dim=0), dim=0).mean(dim=0)
         
-        return loss
+        return torch.mean(loss)
     
 
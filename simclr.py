@@ -49,11 +49,15 @@ class SimCLR(nn.Module):
 
         """
     
-        h1 = self.encoder(x1)
-        h2 = self.encoder(x2)
-    
-        z1 = self.contrastive_head(h1)
-        z2 = self.contrastive_head(h2)
+        # Concatenate both augmentations to run a single pass through the model
+        # (this halves the number of kernel launches and of synchronized
+        # batchnorm reductions in distributed training)
+        x = torch.cat((x1, x2), dim=0)
+        
+        h = self.encoder(x)
+        z = self.contrastive_head(h)
+        
+        z1, z2 = z.chunk(2, dim=0)
         
         return z1, z2
         
@@ -78,6 +82,25 @@ class SimCLR(nn.Module):
         torch.save(state, path)
         
         
+    def cpu_state(self):
+        """
+        Return a copy on CPU of the state of the model, separating the encoder and
+        the head (same format as in save()). The copy is independent of further
+        updates of the weights, thus it can be saved asynchronously.
+
+        Returns
+        -------
+        dict
+            The state of the model.
+
+        """
+        
+        encoder = {k: v.detach().cpu() for k, v in self.encoder.state_dict().items()}
+        head = {k: v.detach().cpu() for k, v in self.contrastive_head.state_dict().items()}
+        
+        return {'encoder': encoder, 'head': head}
+        
+        
     @staticmethod
     def load(path, encoder_arch, head_arch, map_location=None):
         """
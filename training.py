@@ -8,21 +8,168 @@ Created on Tue Jun 28 10:39:37 2022
 
 import torch
 from torch.nn import SyncBatchNorm
+from torch.nn.modules.batchnorm import _BatchNorm
 from torch.utils.tensorboard import SummaryWriter
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook
 import numpy as np
 from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import math
 import os
 
 from finetuning.simclr import SimCLR
 from finetuning.nt_xent import NT_Xent
 from finetuning.lars import LARS
-from finetuning.transforms import ImageDataset
+from finetuning.transforms import ImageDataset, SimCLR_GPU_Transforms
+
+
+class CUDAPrefetcher(object):
+    """
+    Wrap a dataloader to asynchronously copy the batches to the GPU. The copy
+    of the next batch is issued on a side CUDA stream while the current batch
+    is being processed, so that host to device transfers overlap with compute.
+    This needs `pin_memory=True` in the dataloader to be truly asynchronous.
+
+    Parameters
+    ----------
+    dataloader : torch.utils.data.Dataloader
+        The dataloader to wrap.
+    local_rank : int
+        The local rank of the process inside the current node.
+    memory_format : torch.memory_format, optional
+        The memory format of the tensors on the GPU. The default is
+        torch.preserve_format.
+    transform : torch.nn.Module, optional
+        A transformation applied on GPU (on the side stream as well) to each
+        tensor of the batch. If `None`, no transformation is applied. The
+        default is None.
+
+    """
+    
+    def __init__(self, dataloader, local_rank, memory_format=torch.preserve_format,
+                 transform=None):
+        
+        self.dataloader = dataloader
+        self.device = torch.device(f'cuda:{local_rank}')
+        self.memory_format = memory_format
+        self.transform = transform
+        self.stream = torch.cuda.Stream(device=self.device)
+        
+    def __len__(self):
+        return len(self.dataloader)
+    
+    def __iter__(self):
+        
+        loader = iter(self.dataloader)
+        batch = self._preload(loader)
+        
+        while batch is not None:
+            # Make sure the copy of the current batch is done before using it
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # Memory was allocated on the side stream, but is used on the current one
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+            
+            # Start copying the next batch before processing the current one
+            next_batch = self._preload(loader)
+            yield batch
+            batch = next_batch
+            
+    def _preload(self, loader):
+        """
+        Get the next batch from `loader`, copy it to the GPU and transform it on
+        the side stream. Returns `None` if the loader is exhausted.
+        """
+        
+        try:
+            batch = next(loader)
+        except StopIteration:
+            return None
+        
+        with torch.cuda.stream(self.stream):
+            batch = tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+            if self.transform is not None:
+                batch = tuple(self.transform(tensor) for tensor in batch)
+            return tuple(tensor.to(memory_format=self.memory_format) for tensor in batch)
+    
+    
+    
+class FastDistributedSampler(DistributedSampler):
+    """
+    Distributed sampler drawing the permutation of the dataset on GPU, and only
+    converting the indices of the current process to a Python list. The
+    permutation is seeded by `seed + epoch`, thus it is identical across all
+    processes without any communication.
+    See torch.utils.data.distributed.DistributedSampler for the parameters.
+
+    Parameters
+    ----------
+    device : torch.device
+        The device on which to draw the permutation.
+
+    """
+    
+    def __init__(self, dataset, device, **kwargs):
+        
+        super().__init__(dataset, **kwargs)
+        self.device = device
+        
+    def __iter__(self):
+        
+        if self.shuffle:
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=generator,
+                                     device=self.device).cpu()
+        else:
+            indices = torch.arange(len(self.dataset))
+            
+        if not self.drop_last:
+            # Add extra samples to make it evenly divisible
+            padding = self.total_size - len(indices)
+            if padding > 0:
+                repeats = math.ceil(padding / len(indices))
+                indices = torch.cat((indices, indices.repeat(repeats)[:padding]))
+        else:
+            # Remove tail of data to make it evenly divisible
+            indices = indices[:self.total_size]
+            
+        # Subsample for the current process
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        
+        return iter(indices.tolist())
+    
+    
+
+def get_batchnorm_buffers(model):
+    """
+    Returns the buffers (running statistics and number of batches tracked) of
+    all the batchnorm layers of the model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model.
+
+    Returns
+    -------
+    list
+        The buffers.
+
+    """
+    
+    return [buffer for module in model.modules() if isinstance(module, _BatchNorm) \
+            for buffer in module.buffers(recurse=False)]
+
 
 
 def get_optimizer(model, epochs, optimizer, learning_rate, weight_decay,
@@ -74,25 +221,134 @@ def get_optimizer(model, epochs, optimizer, learning_rate, weight_decay,
 
 
 
-def train_one_epoch(model, train_dataloader, criterion, optimizer,
-                    local_rank, distributed):
+def train_one_epoch(model, train_dataloader, criterion, optimizer, scaler,
+                    dtype, local_rank, distributed, accum_steps=1):
+    """
+    Train the model for one epoch. Gradients may be accumulated over several
+    steps before adjusting the weights. Note that this does not increase the
+    number of negative examples seen by the loss (each step only uses its own
+    batch), thus this only trades throughput for memory, contrary to gradient
+    caching (see `train_one_epoch_gradcache`).
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model.
+    train_dataloader : CUDAPrefetcher
+        Dataloader containing the train set.
+    criterion : torch.nn.Module
+        The loss function.
+    optimizer : torch.optim.Optimizer
+        The optimizer used.
+    scaler : torch.amp.GradScaler
+        The gradient scaler (only enabled for float16 mixed precision).
+    dtype : torch.dtype
+        The dtype used for autocasting the forward pass.
+    local_rank : int
+        The local rank of the process inside the current node.
+    distributed : bool
+        Whether we are performing sitributed training or not.
+    accum_steps : int, optional
+        The number of steps over which to accumulate the gradients. The default is 1.
+
+    Returns
+    -------
+    float
+        The loss of the training set (averaged and reduced over all processes).
+
+    """
+        
+    # Accumulate on GPU to avoid a device synchronization at each step
+    running_average_loss = torch.zeros((), device=f'cuda:{local_rank}')
+    
+    # clear the gradients
+    optimizer.zero_grad(set_to_none=True)
+    
+    for step, batch in enumerate(train_dataloader):
+        
+        # Get batch (already on the correct device, in channels_last format)
+        x1, x2 = batch
+        
+        # Whether we adjust the weights at this step
+        update = (step + 1) % accum_steps == 0 or step + 1 == len(train_dataloader)
+        
+        # Number of steps in the current accumulation group (the last group of
+        # the epoch may be smaller)
+        group_start = step - step % accum_steps
+        group_size = min(accum_steps, len(train_dataloader) - group_start)
+        
+        # Gradients are only synchronized across processes before updating
+        if distributed and not update:
+            context = model.no_sync()
+        else:
+            context = nullcontext()
+        
+        with context:
+            # Forward pass and loss in mixed precision
+            with torch.autocast(device_type='cuda', dtype=dtype,
+                                enabled=dtype != torch.float32):
+                h1, h2 = model(x1, x2)
+                loss = criterion(h1, h2)
+            
+            # Backward pass (scaling is a no-op if the scaler is disabled)
+            scaler.scale(loss / group_size).backward()
+        
+        if update:
+            # Adjust the weights
+            scaler.step(optimizer)
+            scaler.update()
+            
+            # clear the gradients
+            optimizer.zero_grad(set_to_none=True)
+        
+        # Update the running average
+        running_average_loss += loss.detach()
+        
+    # Get the average of the loss
+    running_average_loss /= (step+1)
+        
+    # Get average of running losses if distributed training
+    if distributed:
+        dist.all_reduce(running_average_loss,
+                        op=dist.ReduceOp.AVG,
+                        async_op=False)
+        
+    return running_average_loss.item()
+
+
+
+def train_one_epoch_gradcache(model, train_dataloader, criterion, optimizer, scaler,
+                              dtype, local_rank, distributed, sub_batch):
     """
-    Train the model for one epoch.
+    Train the model for one epoch using gradient caching (GradCache). The
+    representations of the whole batch are first computed without gradients by
+    sub-batches, then the loss and its gradients with respect to the
+    representations are computed on the whole batch. Finally, each sub-batch is
+    forwarded again with gradients, and backpropagated using the cached gradients.
+    This gives the same gradients as a large batch step (up to batchnorm
+    statistics which are computed per sub-batch), with the memory footprint
+    of the sub-batch size for the encoder.
 
     Parameters
     ----------
     model : torch.nn.Module
         The model.
-    train_dataloader : torch.utils.data.Dataloader
+    train_dataloader : CUDAPrefetcher
         Dataloader containing the train set.
     criterion : torch.nn.Module
         The loss function.
     optimizer : torch.optim.Optimizer
         The optimizer used.
+    scaler : torch.amp.GradScaler
+        The gradient scaler (only enabled for float16 mixed precision).
+    dtype : torch.dtype
+        The dtype used for autocasting the forward pass.
     local_rank : int
         The local rank of the process inside the current node.
     distributed : bool
         Whether we are performing sitributed training or not.
+    sub_batch : int
+        The size of the sub-batches forwarded through the model at once.
 
     Returns
     -------
@@ -101,36 +357,66 @@ def train_one_epoch(model, train_dataloader, criterion, optimizer,
 
     """
         
-    running_average_loss = 0.
+    # Accumulate on GPU to avoid a device synchronization at each step
+    running_average_loss = torch.zeros((), device=f'cuda:{local_rank}')
     
     for step, batch in enumerate(train_dataloader):
         
-        # Get batch and set devices
+        # Get batch (already on the correct device, in channels_last format)
         x1, x2 = batch
-        x1 = x1.cuda(local_rank)
-        x2 = x2.cuda(local_rank)
         
         # clear the gradients
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
+        
+        x1_chunks = x1.split(sub_batch)
+        x2_chunks = x2.split(sub_batch)
         
-        # Forward pass
-        h1, h2 = model(x1, x2)
+        # Compute the representations of the whole batch without gradients. The
+        # batchnorm statistics are restored afterwards, since they are updated
+        # again by the second pass. Outputs are cloned as CUDA graphs (when the
+        # model is compiled) overwrite them at each call
+        batchnorm_buffers = [buffer.clone() for buffer in get_batchnorm_buffers(model)]
+        with torch.no_grad(), torch.autocast(device_type='cuda', dtype=dtype,
+                                             enabled=dtype != torch.float32):
+            representations = [tuple(z.clone() for z in model(x1_chunk, x2_chunk)) \
+                               for x1_chunk, x2_chunk in zip(x1_chunks, x2_chunks)]
+            for buffer, saved in zip(get_batchnorm_buffers(model), batchnorm_buffers):
+                buffer.copy_(saved)
+        z1 = torch.cat([z1_chunk for z1_chunk, _ in representations], dim=0)
+        z2 = torch.cat([z2_chunk for _, z2_chunk in representations], dim=0)
+        z1.requires_grad_()
+        z2.requires_grad_()
         
-        # Compute the loss and backward pass
-        loss = criterion(h1, h2)
-        loss.backward()
+        # Compute the loss on the whole batch, and cache the gradients with
+        # respect to the representations
+        loss = criterion(z1, z2)
+        scaler.scale(loss).backward()
+        grad1_chunks = z1.grad.split(sub_batch)
+        grad2_chunks = z2.grad.split(sub_batch)
+        
+        # Forward each sub-batch again with gradients and backpropagate the
+        # cached gradients. Gradients are only synchronized on the last sub-batch
+        for i, (x1_chunk, x2_chunk) in enumerate(zip(x1_chunks, x2_chunks)):
+            if distributed and i < len(x1_chunks) - 1:
+                context = model.no_sync()
+            else:
+                context = nullcontext()
+            with context:
+                with torch.autocast(device_type='cuda', dtype=dtype,
+                                    enabled=dtype != torch.float32):
+                    z1_chunk, z2_chunk = model(x1_chunk, x2_chunk)
+                torch.autograd.backward([z1_chunk, z2_chunk],
+                                        [grad1_chunks[i], grad2_chunks[i]])
         
         # Adjust the weights
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         
         # Update the running average
-        running_average_loss += loss.item()
+        running_average_loss += loss.detach()
         
-    # Get the average of the loss and converts to tensor
+    # Get the average of the loss
     running_average_loss /= (step+1)
-    running_average_loss = torch.tensor(running_average_loss,
-                                        dtype=loss.dtype,
-                                        device=loss.device)
         
     # Get average of running losses if distributed training
     if distributed:
@@ -142,55 +428,92 @@ def train_one_epoch(model, train_dataloader, criterion, optimizer,
 
 
 
-def validate_one_epoch(model, val_dataloader, criterion, local_rank):
+def validate_one_epoch(model, val_dataloader, criterion, dtype, local_rank,
+                       distributed):
     """
-    Perform validation for one epoch.
+    Perform validation for one epoch. In distributed training, the sampler pads
+    the validation set with repeated examples so that every process gets the
+    same number of batches. These padded examples are excluded from the
+    average, so that each example of the validation set is counted exactly once
+    (they are still used as negatives for the other examples of their batch).
 
     Parameters
     ----------
     model : torch.nn.Module
         The model.
-    val_dataloader : torch.utils.data.Dataloader
+    val_dataloader : CUDAPrefetcher
         Dataloader corrresponding to the validation set.
     criterion : torch.nn.Module
         The loss function.
+    dtype : torch.dtype
+        The dtype used for autocasting the forward pass.
     local_rank : int
         The local rank of the process inside the current node.
+    distributed : bool
+        Whether we are performing sitributed training or not.
 
     Returns
     -------
     val_loss : float
-        The loss on the validation set.
+        The loss on the validation set (averaged and reduced over all processes).
 
     """
     
-    val_loss = 0.
+    # Accumulate on GPU to avoid a device synchronization at each step
+    val_loss = torch.zeros((), device=f'cuda:{local_rank}')
+    count = torch.zeros((), device=f'cuda:{local_rank}')
+    
+    if distributed:
+        rank = dist.get_rank()
+        world_size = dist.get_world_size()
+    else:
+        rank = 0
+        world_size = 1
+    dataset_size = len(val_dataloader.dataloader.dataset)
+    # Position of the next example in the examples seen by the current process
+    position = 0
     
     with torch.no_grad():
         
         for step, batch in enumerate(val_dataloader):
             
-            # Get batch and set devices
+            # Get batch (already on the correct device, in channels_last format)
             x1, x2 = batch
-            x1 = x1.cuda(local_rank)
-            x2 = x2.cuda(local_rank)
             
-            # Forward pass
-            h1, h2 = model(x1, x2)
+            # Forward pass and loss of each example in mixed precision
+            with torch.autocast(device_type='cuda', dtype=dtype,
+                                enabled=dtype != torch.float32):
+                h1, h2 = model(x1, x2)
+                loss = criterion(h1, h2, reduction='none')
+                
+            # The k-th example of process r is at index r + k*world_size in the
+            # (padded) dataset, thus it is padding if this index is out of range
+            positions = torch.arange(position, position + x1.shape[0], device=loss.device)
+            valid = (rank + positions*world_size < dataset_size).to(loss.dtype)
+            position += x1.shape[0]
             
-            # Compute the loss and backward pass
-            loss = criterion(h1, h2)
-            val_loss += loss.item()
+            val_loss += torch.sum(loss.detach() * valid)
+            count += torch.sum(valid)
+        
+        # Sum losses and number of examples over all processes
+        if distributed:
+            dist.all_reduce(val_loss,
+                            op=dist.ReduceOp.SUM,
+                            async_op=False)
+            dist.all_reduce(count,
+                            op=dist.ReduceOp.SUM,
+                            async_op=False)
             
         # Get the average of the loss 
-        val_loss /= (step+1)
+        val_loss /= count
             
-        return val_loss
+        return val_loss.item()
     
         
 
 def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
-          scheduler, writer, sampler, local_rank):
+          scheduler, scaler, dtype, writer, sampler, local_rank, sub_batch=0,
+          accum_steps=1):
     """
     Train the model for the given number of epochs, and log the results.
 
@@ -200,9 +523,9 @@ def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
         The model.
     epochs : int
         The number of epochs to train for.
-    train_dataloader : torch.utils.data.Dataloader
+    train_dataloader : CUDAPrefetcher
         Dataloader containing the train set.
-    val_dataloader : torch.utils.data.Dataloader
+    val_dataloader : CUDAPrefetcher
         Dataloader corrresponding to the validation set. If `None`, no validation
         is performed.
     criterion : torch.nn.Module
@@ -211,12 +534,22 @@ def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
         The optimizer used.
     scheduler : torch.optim.lr_scheduler
         Scheduler used. If `None`, no scheduling is applied.
+    scaler : torch.amp.GradScaler
+        The gradient scaler (only enabled for float16 mixed precision).
+    dtype : torch.dtype
+        The dtype used for autocasting the forward pass.
     writer : torch.utils.tensorboard.SummaryWriter
         The writer where to log the results.
     sampler : torch.utils.data.distributed.DistributedSampler
         The sampler in case of distributed training.
     local_rank : int
         The local rank of the process inside the current node.
+    sub_batch : int, optional
+        If positive, gradient caching is used with sub-batches of this size.
+        The default is 0.
+    accum_steps : int, optional
+        The number of steps over which to accumulate the gradients (only used
+        if gradient caching is not used). The default is 1.
 
     Returns
     -------
@@ -235,6 +568,14 @@ def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
     # We need to compute the gradients
     torch.set_grad_enabled(True)
     
+    # Folder where to save the models, and thread writing them to disk in the
+    # background (only used by rank 0)
+    if rank == 0:
+        outer_folder, inner_folder = os.path.split(writer.log_dir)
+        save_dir = os.path.join(outer_folder + '_models', inner_folder)
+        save_executor = ThreadPoolExecutor(max_workers=1)
+        save_future = None
+    
     for epoch in range(epochs):
         
         # Set the epoch of the sampler (needed for correct shuffling)
@@ -243,8 +584,14 @@ def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
         
         # Train
         model.train(True)
-        train_loss = train_one_epoch(model, train_dataloader, criterion, optimizer,
-                                     local_rank, distributed)
+        if sub_batch > 0:
+            train_loss = train_one_epoch_gradcache(model, train_dataloader, criterion,
+                                                   optimizer, scaler, dtype, local_rank,
+                                                   distributed, sub_batch)
+        else:
+            train_loss = train_one_epoch(model, train_dataloader, criterion, optimizer,
+                                         scaler, dtype, local_rank, distributed,
+                                         accum_steps)
         
         if scheduler is not None:
             # Get actual learning rate
@@ -255,12 +602,11 @@ def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
         else:
             lr = optimizer.param_groups[0]['lr']
         
-        # Eventually validate (but only on one GPU in case of distributed training)
+        # Eventually validate (sharded across all GPUs in case of distributed training)
         if val_dataloader is not None:
-            if rank == 0:
-                model.eval()
-                val_loss = validate_one_epoch(model, val_dataloader, criterion,
-                                              local_rank)
+            model.eval()
+            val_loss = validate_one_epoch(model, val_dataloader, criterion,
+                                          dtype, local_rank, distributed)
                 
         if rank == 0:
             # Print a summary of current epoch
@@ -277,19 +623,29 @@ def train(model, epochs, train_dataloader, val_dataloader, criterion, optimizer,
             writer.add_scalar("Misc/learning_rate", lr, epoch)
                 
             # Save the actual model
-            outer_folder, inner_folder = writer.log_dir.rsplit('/', 1)
-            path = outer_folder + '_models/' + inner_folder
-            path += f'/epoch_{epoch+1}.pth'
+            path = os.path.join(save_dir, f'epoch_{epoch+1}.pth')
+            # The copy to CPU must be synchronous, as the weights will be updated
+            # during next epoch, but writing to disk is done in the background
             if distributed:
-                model.module.save(path)
+                state = model.module.cpu_state()
             else:
-                model.save(path)
+                state = model.cpu_state()
+            # Wait for previous save (this also raises any error that occured)
+            if save_future is not None:
+                save_future.result()
+            save_future = save_executor.submit(torch.save, state, path)
         
         # Synchonize processes as process on rank 0 should have an overhead
-        # from validation, saving etc...
+        # from logging, saving etc...
         if distributed:
             dist.barrier()
             
+    # Wait for the last model to be written to disk
+    if rank == 0:
+        save_executor.shutdown(wait=True)
+        if save_future is not None:
+            save_future.result()
+            
             
             
 def setup(rank, args):
@@ -347,16 +703,39 @@ def main(local_rank, args):
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
     
+    # Input shapes are fixed, thus let cuDNN find the fastest algorithms, and
+    # use TF32 for convolutions on Ampere and later GPUs. TF32 is not enabled
+    # for matmuls, as the loss must be computed in full precision
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    
     # Model
     path = None if args.model == 'original' else args.model
     model = SimCLR.load(path, args.arch_depth, args.arch_width, args.arch_sk)
     
-    # Configure the model
+    # Configure the model. Use channels_last for the fast NHWC convolution kernels
     model = model.cuda(local_rank)
+    model = model.to(memory_format=torch.channels_last)
     if args.world_size > 1:
         # converts to synchronized batchnorm layers
         model = SyncBatchNorm.convert_sync_batchnorm(model)
-        model = DDP(model, device_ids=[local_rank])
+        # Buffers are already synchronized by the SyncBatchNorm layers
+        model = DDP(model, device_ids=[local_rank], broadcast_buffers=False)
+        # Compress the gradients before the all-reduce to reduce communication
+        if args.comm_hook == 'bf16':
+            model.register_comm_hook(state=None, hook=default_hooks.bf16_compress_hook)
+        elif args.comm_hook == 'fp16':
+            model.register_comm_hook(state=None, hook=default_hooks.fp16_compress_hook)
+        elif args.comm_hook == 'powersgd':
+            state = powerSGD_hook.PowerSGDState(process_group=None,
+                                                matrix_approximation_rank=2)
+            model.register_comm_hook(state=state, hook=powerSGD_hook.powerSGD_hook)
+    if args.compile == 'True':
+        # Compile after wrapping in DDP, so that Dynamo splits the graph at the
+        # DDP buckets boundaries and gradient all-reduce still overlaps with
+        # backward. Shapes are fixed (batch size and image size), thus dynamic=False
+        model = torch.compile(model, mode='max-autotune', fullgraph=False,
+                              dynamic=False)
                    
     # Optimizer and scheduler
     optimizer, scheduler = get_optimizer(model, args.epochs, args.optimizer, 
@@ -365,33 +744,64 @@ def main(local_rank, args):
     if args.scheduler == 'False':
         scheduler = None
         
+    # Mixed precision. Only float16 needs gradient scaling
+    dtype = getattr(torch, args.precision)
+    scaler = torch.amp.GradScaler('cuda', enabled=dtype == torch.float16)
+        
     # Loss
     criterion = NT_Xent(args.temperature)
     
     # Datasets
-    train_dataset = ImageDataset(args.train_dataset, args.size, args.jitter)
+    gpu_augmentation = args.gpu_augmentation == 'True'
+    train_dataset = ImageDataset(args.train_dataset, args.size, args.jitter,
+                                 gpu_augmentation)
     if args.val_dataset != 'None':
-        val_dataset = ImageDataset(args.val_dataset, args.size, args.jitter)
+        val_dataset = ImageDataset(args.val_dataset, args.size, args.jitter,
+                                   gpu_augmentation)
+    
+    # Keep workers alive across epochs and pin memory directly for the correct device
+    loader_kwargs = {'num_workers': args.workers, 'pin_memory': True,
+                     'pin_memory_device': f'cuda:{local_rank}'}
+    if args.workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
     
     # Create the dataloaders
     if args.world_size > 1:
-        train_sampler = DistributedSampler(train_dataset, num_replicas=args.world_size,
-                                           rank=rank, shuffle=True, drop_last=False)
+        train_sampler = FastDistributedSampler(train_dataset, f'cuda:{local_rank}',
+                                               num_replicas=args.world_size, rank=rank,
+                                               shuffle=True, drop_last=False)
         train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size,
-                                      sampler=train_sampler, num_workers=args.workers,
-                                      pin_memory=True, drop_last=True)
+                                      sampler=train_sampler, drop_last=True,
+                                      **loader_kwargs)
     else:
         train_sampler = None
         train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size,
-                                      shuffle=True, num_workers=args.workers,
-                                      pin_memory=True, drop_last=True)
+                                      shuffle=True, drop_last=True, **loader_kwargs)
     if args.val_dataset != 'None':
+        if args.world_size > 1:
+            # Each process validates on a different part of the validation set
+            val_sampler = DistributedSampler(val_dataset, num_replicas=args.world_size,
+                                             rank=rank, shuffle=False, drop_last=False)
+        else:
+            val_sampler = None
         val_dataloader = DataLoader(val_dataset, batch_size=args.batch_size,
-                                    shuffle=False, num_workers=args.workers,
-                                    pin_memory=True, drop_last=False)
+                                    sampler=val_sampler, shuffle=False, drop_last=False,
+                                    **loader_kwargs)
     else:
         val_dataloader = None
         
+    # Asynchronously copy the batches to GPU (in channels_last format), and
+    # eventually perform the end of the data augmentation there
+    if gpu_augmentation:
+        augmentation = SimCLR_GPU_Transforms(args.size, args.jitter).cuda(local_rank)
+    else:
+        augmentation = None
+    train_dataloader = CUDAPrefetcher(train_dataloader, local_rank, torch.channels_last,
+                                      augmentation)
+    if val_dataloader is not None:
+        val_dataloader = CUDAPrefetcher(val_dataloader, local_rank, torch.channels_last,
+                                        augmentation)
+        
     # Configure the writer (will be only used by rank 0)
     if rank == 0:
         timestamp = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
@@ -409,7 +819,8 @@ def main(local_rank, args):
         
     # Perform training
     train(model, args.epochs, train_dataloader, val_dataloader, criterion, optimizer,
-              scheduler, writer, train_sampler, local_rank)
+              scheduler, scaler, dtype, writer, train_sampler, local_rank,
+              args.sub_batch, args.accum_steps)
     
     if rank == 0:
         print('Training ended.')
@@ -442,6 +853,9 @@ def parse_args():
                         help='Size for resizing the images to.')
     parser.add_argument('--jitter', type=float, default=1.,
                         help='Jitter strength for color data augmentation.')
+    parser.add_argument('--gpu_augmentation', type=str, default='False', choices=['False', 'True'],
+                        help=('Whether to perform the color jitter, grayscale and blur '
+                              'augmentations on GPU (requires Kornia).'))
     
     # Training arguments
     parser.add_argument('--optimizer', type=str, default='lars', choices=['lars', 'adam'],
@@ -453,6 +867,12 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, default=32, 
                         help=('The batch size per GPU. Multiply by the number of'
                               ' GPUs and nodes you provide to get the total batch size'))
+    parser.add_argument('--sub_batch', type=int, default=0,
+                        help=('If positive, use gradient caching with sub-batches of '
+                              'this size, to decouple the batch size from GPU memory.'))
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help=('The number of steps over which to accumulate the gradients. '
+                              'This does not increase the number of negatives in the loss.'))
     parser.add_argument('--temperature', type=float, default=0.1, 
                         help='The temperature for the loss.')
     parser.add_argument('--weight_decay', type=float, default=1e-6, 
@@ -463,6 +883,12 @@ def parse_args():
                         help='Whether to apply nesterov momentum if optimizer is `lars`.')
     parser.add_argument('--scheduler', type=str, default='True', choices=['False', 'True'],
                         help='Whether to use a cosine scheduler.')
+    parser.add_argument('--compile', type=str, default='True', choices=['False', 'True'],
+                        help='Whether to compile the model with `torch.compile`.')
+    parser.add_argument('--precision', type=str, default='bfloat16',
+                        choices=['float32', 'bfloat16', 'float16'],
+                        help=('The dtype used for mixed precision training. Use '
+                              '`float16` on GPUs without bfloat16 support.'))
     
     # Config arguments
     parser.add_argument('--nodes', type=int, default=1, 
@@ -473,6 +899,9 @@ def parse_args():
                         help='The number of GPUs to use per node.')
     parser.add_argument('--workers', type=int, default=8,
                         help='The number of workers per GPUs to use.')
+    parser.add_argument('--comm_hook', type=str, default='None',
+                        choices=['None', 'bf16', 'fp16', 'powersgd'],
+                        help='Compression of the gradients for the all-reduce in distributed training.')
     parser.add_argument('--log_dir', type=str, required=True,
                         help='Where to save the results.')
     parser.add_argument('--master_address', type=str, default='localhost',
@@ -485,6 +914,13 @@ def parse_args():
     
     args = parser.parse_args()
     
+    if args.sub_batch < 0:
+        parser.error('`--sub_batch` must be non-negative.')
+    if args.accum_steps < 1:
+        parser.error('`--accum_steps` must be at least 1.')
+    if args.sub_batch > 0 and args.accum_steps > 1:
+        parser.error('`--accum_steps` cannot be used together with `--sub_batch`.')
+    
     args.world_size = args.nodes*args.gpus
     
     # Remove last `/` if present in log_dir
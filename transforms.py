@@ -6,6 +6,7 @@ Created on Tue Jun 28 11:05:38 2022
 @author: cyrilvallez
 """
 
+import torch
 import torchvision
 import torchvision.transforms as T
 from torch.utils.data import Dataset
@@ -13,6 +14,16 @@ from PIL import Image
 import numpy as np
 import os
 
+try:
+    import kornia
+    import kornia.augmentation as K
+except ImportError:
+    K = None
+    
+# Before this version of Kornia, `RandomGaussianBlur` uses a fixed sigma instead
+# of sampling it from a range, and `ColorJitter` does not follow torchvision
+MIN_KORNIA_VERSION = (0, 7)
+
 
 class SimCLR_Transforms(object):
     """
@@ -24,13 +35,19 @@ class SimCLR_Transforms(object):
         Final size for resizing the images. The default is 224.
     jitter : float, optional
         The color jitter strength. The default is 1..
+    gpu_augmentation : bool, optional
+        If `True`, only the geometric transformations (cropping and flipping) are
+        applied, and the images are returned as uint8 tensors. The remaining
+        transformations should then be applied on GPU with `SimCLR_GPU_Transforms`.
+        The default is False.
 
     """
     
-    def __init__(self, size=224, jitter=1.):
+    def __init__(self, size=224, jitter=1., gpu_augmentation=False):
         
         self.size = size
         self.jitter = jitter
+        self.gpu_augmentation = gpu_augmentation
 
         # The following transformations are implementations of the transformations
         # described in the paper on SimCLR v1 (SimCLR v2 uses the same)
@@ -44,26 +61,31 @@ class SimCLR_Transforms(object):
         random_flip = T.RandomHorizontalFlip(p=0.5)
         transforms.append(random_flip)
         
-        # Randomly applied random color jitter
-        color_jitter = T.ColorJitter(0.8*jitter, 0.8*jitter, 0.8*jitter,
-                                     0.2*jitter)
-        random_color_jitter = T.RandomApply([color_jitter], p=0.8)
-        transforms.append(random_color_jitter)
-        
-        # Randomly applied grayscale
-        random_gray = T.RandomGrayscale(p=0.2)
-        transforms.append(random_gray)
-        
-        # Randomly applied random gaussian blur
-        kernel_size = int(0.1*size)
-        if kernel_size % 2 == 0:
-            kernel_size += 1
-        gaussian = T.GaussianBlur(kernel_size, sigma=(0.1, 2.0))
-        random_gaussian = T.RandomApply([gaussian], p=0.5)
-        transforms.append(random_gaussian)
-        
-        # Converts to Tensor
-        transforms.append(T.ToTensor())
+        if gpu_augmentation:
+            # Converts to uint8 Tensor (the rest is performed on GPU)
+            transforms.append(T.PILToTensor())
+            
+        else:
+            # Randomly applied random color jitter
+            color_jitter = T.ColorJitter(0.8*jitter, 0.8*jitter, 0.8*jitter,
+                                         0.2*jitter)
+            random_color_jitter = T.RandomApply([color_jitter], p=0.8)
+            transforms.append(random_color_jitter)
+            
+            # Randomly applied grayscale
+            random_gray = T.RandomGrayscale(p=0.2)
+            transforms.append(random_gray)
+            
+            # Randomly applied random gaussian blur
+            kernel_size = int(0.1*size)
+            if kernel_size % 2 == 0:
+                kernel_size += 1
+            gaussian = T.GaussianBlur(kernel_size, sigma=(0.1, 2.0))
+            random_gaussian = T.RandomApply([gaussian], p=0.5)
+            transforms.append(random_gaussian)
+            
+            # Converts to Tensor
+            transforms.append(T.ToTensor())
         
         self.transforms = T.Compose(transforms)
         
@@ -92,6 +114,72 @@ class SimCLR_Transforms(object):
         return x1, x2
     
     
+    
+class SimCLR_GPU_Transforms(torch.nn.Module):
+    """
+    Represent the photometric part of the data augmentation policy of SimCLR v1
+    and v2 (color jitter, grayscale and gaussian blur), applied on batches
+    directly on GPU using Kornia (version 0.7 or later). This is meant to be
+    used with datasets created with `gpu_augmentation=True`, which only perform
+    the cropping and flipping.
+
+    Parameters
+    ----------
+    size : tuple, optional
+        Final size of the images. The default is 224.
+    jitter : float, optional
+        The color jitter strength. The default is 1..
+
+    """
+    
+    def __init__(self, size=224, jitter=1.):
+        
+        super().__init__()
+        
+        if K is None:
+            raise ImportError('Kornia is needed to perform data augmentation on GPU.')
+        version = tuple(int(x) for x in kornia.__version__.split('.')[:2])
+        if version < MIN_KORNIA_VERSION:
+            raise ImportError(('Kornia >= 0.7 is needed to perform data augmentation on '
+                               f'GPU, but version {kornia.__version__} is installed.'))
+        
+        # Randomly applied random color jitter
+        color_jitter = K.ColorJitter(0.8*jitter, 0.8*jitter, 0.8*jitter,
+                                     0.2*jitter, p=0.8)
+        
+        # Randomly applied grayscale
+        random_gray = K.RandomGrayscale(p=0.2)
+        
+        # Randomly applied random gaussian blur
+        kernel_size = int(0.1*size)
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+        random_gaussian = K.RandomGaussianBlur((kernel_size, kernel_size),
+                                               sigma=(0.1, 2.0), p=0.5)
+        
+        self.transforms = torch.nn.Sequential(color_jitter, random_gray,
+                                              random_gaussian)
+        
+    @torch.no_grad()
+    def forward(self, x):
+        """
+        Draw a data augmentation for each image of the batch.
+
+        Parameters
+        ----------
+        x : Tensor
+            Batch of uint8 images.
+
+        Returns
+        -------
+        Tensor
+            The augmented batch, with values in [0, 1].
+
+        """
+        
+        return self.transforms(x.float() / 255.)
+    
+    
 # Files with this extensions are considered valid images
 VALID_IMAGE_EXTENSION = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')
     
@@ -108,10 +196,14 @@ class ImageDataset(Dataset):
         Final size for resizing the images. The default is 224.
     jitter : float, optional
         The color jitter strength. The default is 1..
+    gpu_augmentation : bool, optional
+        If `True`, only the cropping and flipping are performed, and the other
+        transformations must be applied on GPU with `SimCLR_GPU_Transforms`.
+        The default is False.
 
     """
     
-    def __init__(self, dataset_path, size=224, jitter=1.):
+    def __init__(self, dataset_path, size=224, jitter=1., gpu_augmentation=False):
         
         super().__init__()
         
@@ -133,7 +225,8 @@ class ImageDataset(Dataset):
         elif type(dataset_path) == list:
             self.images = np.array(dataset_path).astype(np.string_)
         
-        self.transforms = SimCLR_Transforms(size=size, jitter=jitter)
+        self.transforms = SimCLR_Transforms(size=size, jitter=jitter,
+                                            gpu_augmentation=gpu_augmentation)
 
     def __len__(self):
         return len(self.images)
@@ -166,16 +259,21 @@ class ImageNet(torchvision.datasets.ImageNet):
         Final size for resizing the images. The default is 224.
     jitter : float, optional
         The color jitter strength. The default is 1..
+    gpu_augmentation : bool, optional
+        If `True`, only the cropping and flipping are performed, and the other
+        transformations must be applied on GPU with `SimCLR_GPU_Transforms`.
+        The default is False.
 
     """
     
     
     def __init__(self, root, split='train', download=False, loader=None,
-                 size=224, jitter=1.):
+                 size=224, jitter=1., gpu_augmentation=False):
         
         super().__init__(root=root, split=split, transform=None,
                          target_transform=None, loader=loader)
-        self.transforms = SimCLR_Transforms(size=size, jitter=jitter)
+        self.transforms = SimCLR_Transforms(size=size, jitter=jitter,
+                                            gpu_augmentation=gpu_augmentation)
         
     def __getitem__(self, index):
         
@@ -206,15 +304,21 @@ class CIFAR10(torchvision.datasets.CIFAR10):
         Final size for resizing the images. The default is 224.
     jitter : float, optional
         The color jitter strength. The default is 1..
+    gpu_augmentation : bool, optional
+        If `True`, only the cropping and flipping are performed, and the other
+        transformations must be applied on GPU with `SimCLR_GPU_Transforms`.
+        The default is False.
 
     """
     
     
-    def __init__(self, root, train=True, download=False, size=224, jitter=1.):
+    def __init__(self, root, train=True, download=False, size=224, jitter=1.,
+                 gpu_augmentation=False):
         
         super().__init__(root=root, train=train, transform=None,
                          target_transform=None, download=download)
-        self.transforms = SimCLR_Transforms(size=size, jitter=jitter)
+        self.transforms = SimCLR_Transforms(size=size, jitter=jitter,
+                                            gpu_augmentation=gpu_augmentation)
         
     def __getitem__(self, index):
         